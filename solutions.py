@@ -1,29 +1,70 @@
 import os
 import io
-import json
-from groq import Groq
+import re
+import asyncio
+import hashlib
+import time
+from functools import lru_cache
+import httpx
+from groq import Groq, AsyncGroq, GroqError
 from pypdf import PdfReader
-from pydantic import BaseModel, Field, ConfigDict
-from openpyxl import Workbook
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
+import xlsxwriter
 import streamlit as st
 from dotenv import load_dotenv
 
 load_dotenv() 
 
 LLM_MODEL = "llama-3.3-70b-versatile"
+STREAM_CHUNKS_PER_PERCENT = 20
+STREAM_PREVIEW_CHARS = 500
+PAGE_HEADER = "\n--- Page %d ---\n"
+# Documents longer than this are split on page boundaries and extracted concurrently
+CHUNK_MAX_CHARS = 12000
+# At most this many chunk requests are in flight at once, to stay under Groq's rate limits
+CHUNK_CONCURRENCY = 4
+# Documents longer than this are refused rather than sent (~100k tokens)
+MAX_DOCUMENT_CHARS = 400000
+GROQ_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+GROQ_MAX_RETRIES = 2
+XLSX_MAX_CELL_CHARS = 32767
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _make_client(api_key: str) -> Groq:
+    """Builds one Groq client per API key, shared across reruns (a few keys at most)."""
+    return Groq(api_key=api_key, timeout=GROQ_TIMEOUT, max_retries=GROQ_MAX_RETRIES)
+
 
 def init_client(api_key: str):
     """Initializes and returns the Groq client."""
+    api_key = api_key.strip()
     if not api_key:
+        st.session_state.pop("_last_err", None)
+        return None, False
+
+    # httpx can only encode ASCII headers; a pasted non-breaking space would
+    # raise UnicodeEncodeError outside the SDK's GroqError wrapping
+    if not (api_key.isascii() and api_key.isprintable()):
+        st.session_state["_last_err"] = "The API key contains non-ASCII or non-printable characters."
         return None, False
 
+    # Skip the probe once this key has succeeded; failures are retried on the next rerun
+    if st.session_state.get("_groq_ok") == api_key:
+        return _make_client(api_key), True
+
+    start = time.perf_counter()
     try:
-        client = Groq(api_key=api_key)
-        client.models.list() 
-        return client, True
-    except:
+        client = _make_client(api_key)
+        client.models.list()
+    except GroqError as e:  # the SDK wraps httpx failures in APIConnectionError/APITimeoutError
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        st.session_state["_last_err"] = f"{type(e).__name__} after {elapsed_ms:.0f} ms: {e}"
         return None, False
 
+    st.session_state["_groq_ok"] = api_key
+    st.session_state.pop("_last_err", None)
+    return client, True
+
 
 
 class ExtractedPair(BaseModel):
@@ -44,109 +85,235 @@ class DocumentStructure(BaseModel):
     )
 
 
+# The JSON example communicates the shape; response_format enforces valid JSON.
+# Kept byte-identical across calls so the provider can reuse the prefix.
+SYSTEM_PROMPT = """You are a data extraction engine. Convert the document text in the user message into JSON.
+
+Output ONLY this JSON object, with no text, markdown or commentary around it:
+{"extracted_data": [{"Key": "Revenue 2023", "Value": "$4.2 million", "Comment": ""}]}
+
+For every sentence or clause in the document:
+1. Value: the single most important fact or phrase, in the document's exact original wording.
+2. Key: a concise, logical label for that Value.
+3. Comment: any remaining text of the source sentence not used in Key or Value; "" if nothing remains.
+
+Rules:
+- Capture 100% of the content across Key, Value and Comment. Do not summarize or omit anything.
+- Keep the original wording and phrasing; paraphrase only when needed to form a clean Key.
+- Do not introduce new information or fabricate details.
+"""
+
+# Matches the start of each PAGE_HEADER written by read_pdf_text
+_PAGE_MARKER_RE = re.compile(r"(?=^--- Page \d+ ---$)", re.MULTILINE)
+
+
+
+@st.cache_data(show_spinner=False)
+def _read_pdf_bytes(_data_bytes: bytes, key: str) -> str:
+    """Extracts the text of a PDF, cached by the content digest in `key`."""
+    # The leading underscore keeps Streamlit from re-hashing the raw bytes;
+    # exceptions are never cached, so a failed read is not stuck in the cache.
+    reader = PdfReader(io.BytesIO(_data_bytes))
+    parts = []
+    for i, page in enumerate(reader.pages):
+        parts.append(PAGE_HEADER % (i + 1))
+        # "plain" skips the glyph-positioning pass of layout mode; the LLM doesn't need it
+        page_text = page.extract_text(extraction_mode="plain")
+        parts.append(page_text if page_text else "(No readable text on this page)")
+    return "".join(parts).strip()
+
+
+def pdf_digest(data: bytes) -> str:
+    """Returns the content digest that identifies an uploaded PDF."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
 
-@st.cache_data
 def read_pdf_text(uploaded_file: io.BytesIO) -> str:
     """Reads all text content from an uploaded PDF file."""
     try:
-        reader = PdfReader(uploaded_file)
-        text = ""
-        for i, page in enumerate(reader.pages):
-            text += f"\n--- Page {i+1} ---\n"
-            page_text = page.extract_text()
-            text += page_text if page_text else "(No readable text on this page)"
-        return text.strip()
+        data = uploaded_file.getvalue()
+        return _read_pdf_bytes(data, pdf_digest(data))
     except Exception as e:
-        # Remove cache on failure so the user can re-upload
-        st.cache_data.clear()
         st.error(f"Error reading PDF: {e}")
         return ""
 
 
-def generate_extraction_prompt(document_text: str) -> str:
-    """
-    Creates the optimized system prompt, using CoT and strict JSON instruction markers.
-    """
-   
-    schema_template = DocumentStructure.model_json_schema(by_alias=True)
-    
-    return f"""
-    You are an advanced AI Data Structuring and Extraction Engine. Your task is to transform the provided
-    unstructured document text into a structured JSON format.
-
-    ## SCHEMA DEFINITION (CRITICAL):
-    Your final output MUST be a JSON object that STRICTLY conforms to the following schema structure. 
-    The single top-level key MUST be "extracted_data" containing an array of objects.
-
-    {json.dumps(schema_template, indent=2)}
-
-    ## PROCESSING METHODOLOGY (MANDATORY CHAIN-OF-THOUGHT):
-    You MUST process the document by following these steps for every unique sentence or clause:
-    1.  **IDENTIFY SOURCE:** Select one complete, logical sentence or clause from the document text.
-    2.  **EXTRACT CORE VALUE:** From that source, extract the single, most important factual metric or phrase. This is the **Value**.
-    3.  **DETERMINE KEY:** Create the most appropriate, concise, and logical **Key** for the fact identified in Step 2.
-    4.  **CAPTURE CONTEXT/RESIDUAL:** Place any remaining associated text from the *original source sentence* that was NOT used in the Key or Value into the **Comment**. If the Key and Value capture the entire logical idea, the comment MUST be **EMPTY ("")**.
-
-    ## STRICT RULES FOR FIDELITY:
-    1.  **100% Capture:** All content MUST be captured across the three columns (Key, Value, Comment). Nothing is summarized or omitted.
-    2.  **Language Preservation (CRITICAL):**
-        * The **Value** MUST **Retain the exact original wording, sentence structure, and phrasing from the PDF**.
-        * **Avoid paraphrasing unless required to form a clean key:value pair**.
-        * **Do not introduce new information** or fabricate details.
-    3.  **Final Output:** You MUST output ONLY the JSON object. DO NOT include any introductory text, markdown, or commentary outside of the JSON block.
-
-    ## DOCUMENT TEXT TO BE PROCESSED:
-    ---
-    {document_text}
-    ---
-    """
+def _split_on_lines(text: str, max_chars: int) -> list[str]:
+    """Breaks `text` into pieces of at most `max_chars` characters, on line boundaries where possible."""
+    pieces, current, size = [], [], 0
+    for line in text.splitlines(keepends=True):
+        # A line longer than max_chars is cut into max_chars-sized slices
+        for start in range(0, len(line), max_chars):
+            part = line[start:start + max_chars]
+            if current and size + len(part) > max_chars:
+                pieces.append("".join(current))
+                current, size = [], 0
+            current.append(part)
+            size += len(part)
+    if current:
+        pieces.append("".join(current))
+    return pieces
+
+
+def split_on_page_markers(document_text: str, max_chars: int = CHUNK_MAX_CHARS) -> list[str]:
+    """Groups whole pages of `document_text` into chunks of at most `max_chars` characters."""
+    chunks, current, size = [], [], 0
+    for page in _PAGE_MARKER_RE.split(document_text):
+        if not page:
+            continue
+        # Pages that are too long on their own are split on line boundaries
+        pieces = _split_on_lines(page, max_chars) if len(page) > max_chars else [page]
+        for piece in pieces:
+            if current and size + len(piece) > max_chars:
+                chunks.append("".join(current).strip())
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece)
+    if current:
+        chunks.append("".join(current).strip())
+    return chunks
+
+
+@lru_cache(maxsize=8)
+def _chunks_for(document_text: str) -> tuple[str, ...]:
+    """Returns the request-sized pieces of a document, reused when "Run" is clicked again."""
+    # Cheap length check first; only long documents need splitting
+    if len(document_text) > CHUNK_MAX_CHARS:
+        return tuple(split_on_page_markers(document_text))
+    return (document_text,)
+
+
+def _build_messages(document_text: str) -> list[dict]:
+    """Pairs the static system prompt with the document as the only varying message."""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": document_text}
+    ]
+
+
+def _parse_pairs(json_string: str) -> list[ExtractedPair]:
+    """Parses and validates an LLM response in one pass, returning its rows."""
+    return DocumentStructure.model_validate_json(json_string).extracted_data
+
+
+def _extract_streaming(client: Groq, document_text: str, progress_bar) -> list[ExtractedPair]:
+    """Runs a single extraction request, showing tokens as they arrive."""
+    stream = client.chat.completions.create(
+        messages=_build_messages(document_text),
+        model=LLM_MODEL,
+        response_format={"type": "json_object"},
+        temperature=0.0,
+        stream=True
+    )
+
+    placeholder = st.empty()
+    buf = []
+    tail = ""
+    try:
+        for n_chunks, chunk in enumerate(stream, start=1):
+            piece = chunk.choices[0].delta.content or ""
+            buf.append(piece)
+            tail = (tail + piece)[-STREAM_PREVIEW_CHARS:]
+            # Refresh the UI once per percent step rather than on every token
+            if n_chunks % STREAM_CHUNKS_PER_PERCENT == 0:
+                placeholder.code(tail, language="json")
+                # Creep from 60% towards 79% as the response streams in
+                pct = min(79, 60 + n_chunks // STREAM_CHUNKS_PER_PERCENT)
+                progress_bar.progress(pct, text=f"{pct}% - Receiving structured data from Groq LLM...")
+    finally:
+        placeholder.empty()
+
+    progress_bar.progress(80, text="80% - Validating JSON...")
+    return _parse_pairs("".join(buf))
+
+
+async def _extract_chunks_async(api_key: str, chunks: tuple[str, ...], progress_bar) -> list[ExtractedPair]:
+    """Extracts the chunks concurrently and merges the rows in document order."""
+    done = 0
+    semaphore = asyncio.Semaphore(CHUNK_CONCURRENCY)
+
+    async with AsyncGroq(api_key=api_key, timeout=GROQ_TIMEOUT, max_retries=GROQ_MAX_RETRIES) as aclient:
+        async def run_one(chunk: str) -> list[ExtractedPair]:
+            nonlocal done
+            async with semaphore:
+                chat_completion = await aclient.chat.completions.create(
+                    messages=_build_messages(chunk),
+                    model=LLM_MODEL,
+                    response_format={"type": "json_object"},
+                    temperature=0.0
+                )
+            pairs = _parse_pairs(chat_completion.choices[0].message.content)
+            done += 1
+            pct = 60 + 20 * done // len(chunks)
+            progress_bar.progress(pct, text=f"{pct}% - Extracted chunk {done}/{len(chunks)}...")
+            return pairs
+
+        results = await asyncio.gather(*(run_one(chunk) for chunk in chunks), return_exceptions=True)
+
+    # A partial spreadsheet would silently break the 100% capture guarantee,
+    # so any failed chunk fails the run, naming every chunk that failed
+    failures = [(i, r) for i, r in enumerate(results, start=1) if isinstance(r, Exception)]
+    if failures:
+        raise ExceptionGroup(
+            "; ".join(f"chunk {i}/{len(chunks)}: {type(r).__name__}: {r}" for i, r in failures),
+            [r for _, r in failures]
+        )
+
+    return [pair for pairs in results for pair in pairs]
 
 
 def extract_data_with_llm(client: Groq, document_text: str, progress_bar):
-    system_prompt = generate_extraction_prompt(document_text)
+    chunks = _chunks_for(document_text)
 
     try:
         progress_bar.progress(60, text="60% - Sending data to Groq LLM...")
 
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": "BEGIN EXTRACTION: Return the structured JSON immediately."}
-            ],
-            model=LLM_MODEL,
-            response_format={"type": "json_object"},
-            temperature=0.0
-        )
-
-        progress_bar.progress(80, text="80% - Validating JSON...")
-
-        json_string = chat_completion.choices[0].message.content
-        data_model = DocumentStructure.model_validate_json(json_string)
+        if len(chunks) > 1:
+            extracted_data = asyncio.run(_extract_chunks_async(client.api_key, chunks, progress_bar))
+        else:
+            extracted_data = _extract_streaming(client, document_text, progress_bar)
 
         progress_bar.progress(95, text="95% - Success!")
 
-        return data_model.extracted_data
+        return extracted_data
 
     except Exception as e:
         progress_bar.empty()
         st.error(f"❌ LLM Error: {e}")
-        st.caption("The LLM likely returned text/JSON that did not strictly contain the 'extracted_data' list. This is a model adherence issue.")
+        errors = e.exceptions if isinstance(e, ExceptionGroup) else (e,)
+        if any(isinstance(err, ValidationError) for err in errors):
+            st.caption("The LLM likely returned text/JSON that did not strictly contain the 'extracted_data' list. This is a model adherence issue.")
+        if any(isinstance(err, GroqError) for err in errors):
+            st.caption("The Groq API rejected or dropped the request (rate limit, timeout or network issue). Wait a moment and run the extraction again.")
         return None
 
 
 def create_excel_bytes(extracted_data, progress_bar):
     progress_bar.progress(98, text="98% - Generating Excel...")
 
-    wb = Workbook()
-    ws = wb.active
-    ws.append(["Key", "Value", "Comment"])
-
-    for item in extracted_data:
-        row = item.model_dump(by_alias=True)
-        ws.append([row["Key"], row["Value"], row["Comment"]])
-
+    # constant_memory flushes each row as soon as the next one starts.
+    # Not combined with in_memory, which would silently disable it.
     stream = io.BytesIO()
-    wb.save(stream)
+    wb = xlsxwriter.Workbook(stream, {"constant_memory": True})
+    ws = wb.add_worksheet()
+    ws.write_row(0, 0, ("Key", "Value", "Comment"))
+
+    # write_string keeps every cell literal text: write_row would turn URL-like
+    # or "="-prefixed strings into links or formulas and alter the wording
+    truncated = []
+    for i, item in enumerate(extracted_data, start=1):
+        for col, text in enumerate((item.Key, item.Value, item.comment)):
+            # -2 means the string was cut to Excel's per-cell limit
+            if ws.write_string(i, col, text) == -2:
+                truncated.append(f"{'ABC'[col]}{i + 1}")
+
+    wb.close()
+
+    if truncated:
+        st.warning(
+            f"Excel cells hold at most {XLSX_MAX_CELL_CHARS:,} characters; "
+            f"these cells were truncated: {', '.join(truncated)}"
+        )
 
     progress_bar.progress(100, text="Done!")
     return stream.getvalue()
@@ -177,6 +344,8 @@ def main():
             st.success(f"API Status: Connected to GroqCloud")
         else:
             st.error("API Status: Disconnected")
+            if "_last_err" in st.session_state:
+                st.caption(st.session_state["_last_err"])
             st.info("Enter a valid API key in the field above to enable the LLM.")
 
         st.markdown("---")
@@ -193,9 +362,12 @@ def main():
     if uploaded_file:
         st.success(f"Uploaded: {uploaded_file.name}")
 
-        if uploaded_file.name != st.session_state.get('last_uploaded_file'):
+        digest = pdf_digest(uploaded_file.getvalue())
+        if digest != st.session_state.get('last_uploaded_digest'):
              st.session_state['pdf_content'] = read_pdf_text(uploaded_file)
-             st.session_state['last_uploaded_file'] = uploaded_file.name
+             # Only remember a successful read, so a failed one is retried
+             if st.session_state['pdf_content']:
+                 st.session_state['last_uploaded_digest'] = digest
         
         if 'pdf_content' not in st.session_state:
              st.session_state['pdf_content'] = read_pdf_text(uploaded_file)
@@ -221,6 +393,13 @@ def main():
                 st.warning("Cannot proceed: PDF text content is empty.")
                 return
 
+            if len(pdf_text) > MAX_DOCUMENT_CHARS:
+                st.warning(
+                    f"Cannot proceed: the PDF text is {len(pdf_text):,} characters, "
+                    f"above the {MAX_DOCUMENT_CHARS:,} character limit."
+                )
+                return
+
             progress = st.progress(10, text="Starting LLM Processing...")
 
             data = extract_data_with_llm(client, pdf_text, progress)
@@ -230,7 +409,12 @@ def main():
 
                 excel_bytes = create_excel_bytes(data, progress)
                 
-                st.dataframe([d.model_dump(by_alias=True) for d in data], use_container_width=True, height=300)
+                preview = {
+                    "Key": [d.Key for d in data],
+                    "Value": [d.Value for d in data],
+                    "Comment": [d.comment for d in data],
+                }
+                st.dataframe(preview, use_container_width=True, height=300)
 
                 st.download_button(
                     "⬇️ Download Structured Output.xlsx",